@@ -1,11 +1,14 @@
 import asyncio
 import base64
-import json
+import httpx
+import os
+import sys
+import termios
+import tty
+import orjson
 import pyaudio
 import websockets
-import time
-from pynput import keyboard
-from openai import OpenAI
+from openai import DEFAULT_CONNECTION_LIMITS, AsyncOpenAI, DefaultAsyncHttpxClient
 from configure import auth_key, OPENAI_API_KEY, system_prompt, ai_model, user_name, interviewer_name
 
 class RealtimeTranscriber:
@@ -15,11 +18,19 @@ class RealtimeTranscriber:
     """
 
     # Constants for audio configuration
-    FRAMES_PER_BUFFER = 3200
+    FRAMES_PER_BUFFER = 1600  # 100ms of audio at 16kHz
     FORMAT = pyaudio.paInt16
     CHANNELS = 1
     RATE = 16000
     WEBSOCKET_URL = "wss://api.assemblyai.com/v2/realtime/ws?sample_rate=16000"
+    MAX_BUFFERS_PER_MESSAGE = 2 * RATE // FRAMES_PER_BUFFER  # AssemblyAI accepts at most 2000ms of audio per message
+    KEEPALIVE_INTERVAL = 3  # Seconds between silence frames sent while transcription is paused
+    # 100ms of silence, enough to keep the AssemblyAI session from going idle
+    KEEPALIVE_MESSAGE = '{"audio_data":"' + base64.b64encode(bytes(2 * RATE // 10)).decode("ascii") + '"}'
+
+    # Constants for conversation history
+    PINNED_MESSAGES = 2  # System prompt and style note, always kept at the start of the history
+    MAX_TURNS = 10  # Number of recent user/assistant turns sent to OpenAI
 
     def __init__(self):
         """
@@ -28,17 +39,28 @@ class RealtimeTranscriber:
         Args:
             ai_model: The AI model used for generating responses (default is GPT-4).
         """
+        self._raise_priority()  # Before PyAudio starts any threads, so they inherit it
         self.audio = pyaudio.PyAudio()  # Initialize the PyAudio object
         self.model = ai_model  # AI model used for OpenAI's API
         self.user_message = ""  # Stores the user's spoken message
         self.user_name = user_name  # The name of the user speaking
         self.interviewer_name = interviewer_name  # The name of the interviewer
-        self.assistant_message = ""  # Stores the assistant's message
         self.messages = [{"role": "system", "content": system_prompt}]  # Initializes message history with the system prompt
         
         # Append a user note to the message history to guide GPTs response style
         self.append_message("user", "Note: Remember to always be concise, brief, straight-to-the-point...")
-        self.openai_client = OpenAI(api_key=OPENAI_API_KEY)  # Initialize the OpenAI client
+        # Initialize the OpenAI client on a pooled HTTP/2 connection so later responses reuse the TLS session
+        self._http = DefaultAsyncHttpxClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=DEFAULT_CONNECTION_LIMITS.max_connections,
+                max_keepalive_connections=4,
+                keepalive_expiry=60.0
+            )
+        )
+        self.openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=self._http)
+        self._response_task = None  # Task handling the latest transcript, chained after any earlier ones
+        self._main_task = None  # Task running send_receive, cancelled on exit
         
         # Open an audio stream with the specified format, channels, rate, etc.
         self.stream = self.audio.open(
@@ -47,10 +69,36 @@ class RealtimeTranscriber:
             rate=self.RATE,
             input=True,
             frames_per_buffer=self.FRAMES_PER_BUFFER,
-            input_device_index=1  # Index of the input device (may need to be changed based on hardware)
+            input_device_index=1,  # Index of the input device (may need to be changed based on hardware)
+            stream_callback=self._on_audio  # PortAudio's capture thread pushes buffers to us
         )
         self.transcribing = False  # Flag to track if transcription has started
         self.stop_transcription = False  # Flag to indicate when to stop transcription
+        self._loop = None  # Event loop running send_receive, set once it starts
+        self._audio_q = None  # Queue of raw PCM buffers filled by the audio callback
+        self._out_q = None  # Queue of encoded messages waiting to be written to the WebSocket
+        self._transcribing_ev = None  # Set while transcription is active, created with the event loop
+
+    def _raise_priority(self):
+        """
+        Raises the scheduling priority of the process where the OS allows it.
+        Threads started afterwards, including PortAudio's capture thread, inherit it,
+        which reduces capture jitter and dropped frames under load.
+        """
+        try:
+            os.nice(-10)
+        except OSError:
+            pass  # Not permitted for unprivileged users; keep the default priority
+
+    def _on_audio(self, in_data, frame_count, time_info, status):
+        """
+        PyAudio stream callback, called from PortAudio's capture thread.
+        Hands captured audio over to the event loop while transcription is active.
+        """
+        loop = self._loop
+        if self.transcribing and loop is not None:
+            loop.call_soon_threadsafe(self._audio_q.put_nowait, in_data)
+        return (None, pyaudio.paContinue)
 
     def append_message(self, role: str, message: str):
         """
@@ -61,29 +109,81 @@ class RealtimeTranscriber:
             message: The content of the message.
         """
         self.messages.append({"role": role, "content": message})
+        # Drop the oldest turns so the request payload stays bounded
+        excess = len(self.messages) - self.PINNED_MESSAGES - 2 * self.MAX_TURNS
+        if excess > 0:
+            excess += excess % 2  # Trim whole user/assistant pairs so the window never starts with a reply
+            del self.messages[self.PINNED_MESSAGES:self.PINNED_MESSAGES + excess]
 
     async def send_receive(self):
         """
         Manages the sending and receiving of data via WebSocket.
         Handles the WebSocket connection and orchestrates the sending and receiving tasks.
         """
+        self._audio_q = asyncio.Queue()
+        self._transcribing_ev = asyncio.Event()
+        if self.transcribing:
+            self._transcribing_ev.set()
+        self._loop = asyncio.get_running_loop()
+        self._main_task = asyncio.current_task()
+
+        old_term_attrs = None
+        try:
+            if sys.stdin is None or not sys.stdin.isatty():
+                print("Key presses are read from the terminal; run main.py from an interactive terminal.")
+                return
+            # Read key presses from the terminal one at a time, without waiting for Enter
+            stdin_fd = sys.stdin.fileno()
+            old_term_attrs = termios.tcgetattr(stdin_fd)
+            tty.setcbreak(stdin_fd)
+            self._loop.add_reader(stdin_fd, self._on_stdin)
+            await self._connect_loop()
+        finally:
+            if old_term_attrs is not None:
+                self._loop.remove_reader(stdin_fd)
+                termios.tcsetattr(stdin_fd, termios.TCSADRAIN, old_term_attrs)
+            # Stop the capture thread before the loop it hands audio to is closed
+            self.stream.stop_stream()
+            self.stream.close()
+            self.audio.terminate()
+            self._loop = None
+            # Don't close the HTTP client under a response that is still streaming
+            if self._response_task is not None:
+                self._response_task.cancel()
+                await asyncio.gather(self._response_task, return_exceptions=True)
+            await self._http.aclose()
+
+    async def _connect_loop(self):
+        """
+        Connects to AssemblyAI and runs the session tasks.
+        Reconnects when the session is closed for being idle.
+        """
         while not self.stop_transcription:
             # Handle the WebSocket connection and catch any exceptions
             try:
                 async with websockets.connect(
                     self.WEBSOCKET_URL,
                     extra_headers=(("Authorization", auth_key),),
-                    ping_interval=5,
+                    ping_interval=20,
                     ping_timeout=20
                 ) as websocket:
                     await asyncio.sleep(0.1)  # Short delay before starting
                     if not self.transcribing:
                         print("Press spacebar to start transcription.")
 
-                    # Create tasks for sending audio and receiving transcripts
-                    send_task = asyncio.create_task(self.send_audio(websocket))
-                    receive_task = asyncio.create_task(self.receive_transcript(websocket))
-                    await asyncio.gather(send_task, receive_task)
+                    # Create tasks for encoding audio, writing it out and receiving transcripts
+                    self._out_q = asyncio.Queue(maxsize=64)
+                    tasks = [
+                        asyncio.create_task(self.send_audio()),
+                        asyncio.create_task(self._writer(websocket)),
+                        asyncio.create_task(self.receive_transcript(websocket)),
+                    ]
+                    try:
+                        await asyncio.gather(*tasks)
+                    finally:
+                        # Don't leave tasks from a dead connection consuming audio
+                        for task in tasks:
+                            task.cancel()
             except websockets.exceptions.ConnectionClosedError as e:
                 if "Session idle for too long" not in str(e):
                     raise
@@ -93,19 +193,40 @@ class RealtimeTranscriber:
                 print(f"Unexpected error: {e}")
                 break
 
-    async def send_audio(self, websocket):
+    async def send_audio(self):
         """
-        Sends audio data to the WebSocket.
-        Continuously reads audio from the stream and sends it to AssemblyAI for transcription.
+        Queues audio data for the WebSocket.
+        Waits for audio captured by the stream callback and encodes it for AssemblyAI to transcribe.
         """
+        b64encode = base64.b64encode  # Local binding for the hot loop
         while not self.stop_transcription:
-            if self.transcribing:
-                # Read audio data and encode it to base64
-                data = self.stream.read(self.FRAMES_PER_BUFFER, exception_on_overflow=False)
-                encoded_data = base64.b64encode(data).decode("utf-8")
-                # Send the encoded audio data to the WebSocket
-                await websocket.send(json.dumps({"audio_data": encoded_data}))
-            await asyncio.sleep(0.01)  # Short delay between audio sends
+            if not self._transcribing_ev.is_set() and self._audio_q.empty():
+                # Block while transcription is paused, sending silence now and then to keep the session warm
+                try:
+                    await asyncio.wait_for(self._transcribing_ev.wait(), self.KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    await self._out_q.put(self.KEEPALIVE_MESSAGE)
+                    continue
+            # Wait for the next captured buffer and encode it to base64
+            data = await self._audio_q.get()
+            # Coalesce any buffers that piled up meanwhile into a single message, up to AssemblyAI's limit
+            for _ in range(self.MAX_BUFFERS_PER_MESSAGE - 1):
+                if self._audio_q.empty():
+                    break
+                data += self._audio_q.get_nowait()
+            if data:
+                encoded_data = b64encode(data).decode("ascii")
+                # Queue the encoded audio data for the writer; the envelope is fixed, so skip the JSON encoder
+                await self._out_q.put('{"audio_data":"' + encoded_data + '"}')
+
+    async def _writer(self, websocket):
+        """
+        Writes queued messages to the WebSocket.
+        Keeps WebSocket flow control from holding up audio encoding.
+        """
+        while True:
+            message = await self._out_q.get()
+            await websocket.send(message)
 
     async def receive_transcript(self, websocket):
         """
@@ -114,43 +235,61 @@ class RealtimeTranscriber:
         """
         while not self.stop_transcription:
             result = await websocket.recv()  # Receive transcription result
-            transcript = json.loads(result)  # Decode JSON response
+            if '"FinalTranscript"' not in result:
+                continue  # Skip partial transcripts without decoding them
+            transcript = orjson.loads(result)  # Decode JSON response
             if 'text' in transcript and transcript['message_type'] == 'FinalTranscript':
                 self.user_message += transcript['text']  # Append the text to the user's message
-                if not self.transcribing:
-                    print(f"{self.interviewer_name}: {self.user_message}\n")
-                    self.append_message("user", self.user_message)
-                    self.process_transcripts(self.user_message)  # Process the transcript through OpenAI
+                if not self.transcribing and self.user_message:
+                    # Process the transcript through OpenAI without holding up the audio and transcript loops,
+                    # after any response that is still streaming
+                    self._response_task = asyncio.create_task(
+                        self.process_transcripts(self.user_message, self._response_task)
+                    )
                     self.user_message = ""  # Reset the user message
-            await asyncio.sleep(0.01)  # Short delay between receiving messages
 
-    def process_transcripts(self, transcript):
+    async def process_transcripts(self, transcript, previous_task=None):
         """
         Processes the transcript through OpenAI's API.
         Sends the user's transcript to OpenAI's GPT model and prints the assistant's response.
+
+        Args:
+            transcript: The user's transcribed message.
+            previous_task: The task handling the previous transcript, waited on so responses don't overlap.
         """
+        if previous_task is not None:
+            await previous_task
+        print(f"{self.interviewer_name}: {transcript}\n")
+        self.append_message("user", transcript)
         print("Processing...\n")
         print(f"{self.user_name}: ", end='', flush=True)
-        # Get response from OpenAI and print it
-        for content in self.get_response_from_openai(transcript):
-            if content:
-                print(content, end='', flush=True)
-                self.assistant_message += content
-        self.append_message("assistant", self.assistant_message)  # Append the assistant's response
+        # Get response from OpenAI and print it, collecting the chunks to join once at the end
+        chunks = []
+        write, flush = sys.stdout.write, sys.stdout.flush
+        try:
+            async for content in self.get_response_from_openai(transcript):
+                if content:
+                    write(content)
+                    flush()
+                    chunks.append(content)
+        except Exception as e:
+            print(f"\nUnexpected error: {e}")
+            self.messages.pop()  # Drop the unanswered message to keep user/assistant turns paired
+        else:
+            self.append_message("assistant", "".join(chunks))  # Append the assistant's response
         print("\n\nPress spacebar to continue transcription.")  # Instruction to continue transcription
-        self.assistant_message = ""  # Reset the assistant message
 
-    def get_response_from_openai(self, transcript):
+    async def get_response_from_openai(self, transcript):
         """
         Yields the response from OpenAI's API.
         Retrieves the conversation from OpenAI's API and yields the response content.
         """
-        stream = self.openai_client.chat.completions.create(
+        stream = await self.openai_client.chat.completions.create(
             model=self.model,
             messages=self.messages,
             stream=True
         )
-        for response in stream:
+        async for response in stream:
             yield response.choices[0].delta.content
 
     def toggle_transcription(self):
@@ -159,32 +298,48 @@ class RealtimeTranscriber:
         Switches the transcription state between paused and active.
         """
         self.transcribing = not self.transcribing  # Toggle the transcribing flag
+        if self.transcribing:
+            self._transcribing_ev.set()
+        else:
+            self._transcribing_ev.clear()
+            self._audio_q.put_nowait(b"")  # Wake send_audio so it sends the remaining audio, then idles
         status = "started" if self.transcribing else "paused"
         print(f"Transcription {status}. Press spacebar to toggle...\n")
 
     def run(self):
         """
         Starts the transcriber.
-        Initializes the key listener and starts the send/receive loop.
+        Starts the send/receive loop, which also listens for key presses.
         """
-        listener = keyboard.Listener(on_press=self.on_key_press)
-        listener.start()  # Start listening for key presses
-        asyncio.run(self.send_receive())  # Start the send/receive loop
-        listener.join()  # Join the listener thread
+        try:
+            import uvloop  # Faster event loop, available on Linux and macOS
+        except ImportError:
+            asyncio.run(self.send_receive())  # Start the send/receive loop
+        else:
+            uvloop.run(self.send_receive())  # Start the send/receive loop on uvloop
 
-    def on_key_press(self, key):
+    def _on_stdin(self):
         """
-        Handles key press events.
+        Handles key presses read from the terminal.
         Toggles transcription on spacebar press and stops transcription on escape key press.
         """
-        if key == keyboard.Key.space:
-            if self.transcribing:
-                time.sleep(0.3)  # Added delay to process any remaining transcription
-            self.toggle_transcription()  # Toggle the transcription state
-        elif key == keyboard.Key.esc:
+        stdin_fd = sys.stdin.fileno()
+        keys = os.read(stdin_fd, 32)
+        if not keys:
+            self._loop.remove_reader(stdin_fd)  # EOF or terminal hangup, stop watching stdin
+            return
+        for key in keys:
+            if key == ord(" "):
+                if self.transcribing:
+                    # Added delay to process any remaining transcription
+                    self._loop.call_later(0.3, self.toggle_transcription)
+                else:
+                    self.toggle_transcription()  # Toggle the transcription state
+        # A lone Escape; arrow and function keys send escape sequences with more bytes after it
+        if keys[-1] == 0x1b:
             print("Exiting transcription.")
             self.stop_transcription = True  # Set flag to stop transcription
-            return False  # Stop the listener
+            self._main_task.cancel()  # Unblock the session tasks waiting on audio or the WebSocket
 
 # Main execution
 if __name__ == "__main__":